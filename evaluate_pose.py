@@ -83,7 +83,10 @@ def evaluate(opt):
     dataloader = DataLoader(dataset, opt.batch_size, shuffle=False,
                             num_workers=opt.num_workers, pin_memory=True, drop_last=False)
 
-    pose_encoder_path = os.path.join(opt.load_weights_folder, "pose_encoder.pth")
+    # with --share_pose_encoder the pose decoder reads the position encoder features
+    pose_encoder_path = os.path.join(opt.load_weights_folder,
+                                     "position_encoder.pth" if opt.share_pose_encoder else "pose_encoder.pth")
+    assert os.path.isfile(pose_encoder_path), "Cannot find {}".format(pose_encoder_path)
     pose_decoder_path = os.path.join(opt.load_weights_folder, "pose.pth")
 
     pose_encoder = networks.ResnetEncoder(opt.num_layers, False, 2)
@@ -144,19 +144,19 @@ class BackprojectDepth(nn.Module):
         self.height = height
         self.width = width
 
+        # constant fp32 grids, non-persistent so they stay out of the state dict
         meshgrid = np.meshgrid(range(self.width), range(self.height), indexing='xy')
-        self.id_coords = np.stack(meshgrid, axis=0).astype(np.float32)
-        self.id_coords = nn.Parameter(torch.from_numpy(self.id_coords),
-                                      requires_grad=False)
+        id_coords = torch.from_numpy(np.stack(meshgrid, axis=0).astype(np.float32))
+        self.register_buffer("id_coords", id_coords, persistent=False)
 
-        self.ones = nn.Parameter(torch.ones(self.batch_size, 1, self.height * self.width),
-                                 requires_grad=False)
+        ones = torch.ones(self.batch_size, 1, self.height * self.width)
+        self.register_buffer("ones", ones, persistent=False)
 
-        self.pix_coords = torch.unsqueeze(torch.stack(
-            [self.id_coords[0].view(-1), self.id_coords[1].view(-1)], 0), 0)
-        self.pix_coords = self.pix_coords.repeat(batch_size, 1, 1)
-        self.pix_coords = nn.Parameter(torch.cat([self.pix_coords, self.ones], 1),
-                                       requires_grad=False)
+        pix_coords = torch.unsqueeze(torch.stack(
+            [id_coords[0].view(-1), id_coords[1].view(-1)], 0), 0)
+        pix_coords = pix_coords.repeat(batch_size, 1, 1)
+        self.register_buffer("pix_coords", torch.cat([pix_coords, ones], 1).contiguous(),
+                             persistent=False)
 
     def forward(self, depth, inv_K):
         cam_points = torch.matmul(inv_K[:, :3, :3], self.pix_coords)
@@ -266,6 +266,14 @@ def get_smooth_bright(transform, target, pred, occu_mask):
     return (grad_transform_x.sum() / mask_x.sum() + grad_transform_y.sum() / mask_y.sum())
 
 
+@torch.jit.script
+def fuse_ref(transform, occu_mask, color):
+    """Apply the appearance flow to an image and clamp the result to [0, 1]
+    Scripted so that the multiply, add and clamp run as a single fused kernel
+    """
+    return torch.clamp(transform * occu_mask + color, 0.0, 1.0)
+
+
 def get_smooth_registration(position):
     
     """Computes the smoothness loss for a optical flow
@@ -805,4 +813,75 @@ def flow2coord(flow):
     ones = torch.ones((b, 1, h*w), dtype=torch.float32).cuda()
     coord1_hom = torch.cat((coord1_flat, ones), dim=1)
     coord2_hom = torch.cat((coord2_flat, ones), dim=1)
-    return coord1_hom, coord2_hom
\ No newline at end of file
+    return coord1_hom, coord2_hom
+
+
+def flow2coord_at(flow, pts):
+    """
+    Generate homogeneous coordinates 1 and 2 of some pixels from the optical flow of one pair,
+    without building the dense coordinate maps.
+    Args:
+        flow: 2xhxw, torch.float32
+        pts: Nx2 pixel (x, y) indices, torch.int64
+    Output:
+        coord1_hom: 3xN, torch.float32
+        coord2_hom: 3xN, torch.float32
+    """
+    # float32 even under autocast, half precision only resolves 0.25 pixel above 256
+    coord1 = pts.t().float()
+    coord2 = coord1 + flow[:, pts[:, 1], pts[:, 0]].float()
+    coord1_hom = F.pad(coord1, (0, 0, 0, 1), value=1.0)
+    coord2_hom = F.pad(coord2, (0, 0, 0, 1), value=1.0)
+    return coord1_hom, coord2_hom
+
+
+def bilinear_gather(feat, xy):
+    """Bilinearly sample a CxHxW map at N (x, y) pixel positions, like grid_sample with
+    align_corners=True but without building and normalising a sampling grid. Returns CxN
+    """
+    _, h, w = feat.shape
+    x, y = xy[:, 0], xy[:, 1]
+    x0 = x.floor().clamp(0, w - 1); y0 = y.floor().clamp(0, h - 1)
+    x1 = (x0 + 1).clamp(max=w - 1); y1 = (y0 + 1).clamp(max=h - 1)
+    wx = x - x0; wy = y - y0
+    x0, x1, y0, y1 = x0.long(), x1.long(), y0.long(), y1.long()
+    return feat[:, y0, x0] * (1 - wx) * (1 - wy) + feat[:, y0, x1] * wx * (1 - wy) + \
+        feat[:, y1, x0] * (1 - wx) * wy + feat[:, y1, x1] * wx * wy
+
+
+def int8_sq_dists(des1, des2):
+    """Squared L2 distances between two sets of descriptors (NxD and MxD) quantized to int8,
+    as |a|^2 + |b|^2 - 2ab with the products computed by an int8 matmul
+    """
+    scale = 127.0 / torch.max(des1.abs().max(), des2.abs().max()).clamp(min=1e-12)
+    q1 = torch.round(des1 * scale).to(torch.int8)
+    q2 = torch.round(des2 * scale).to(torch.int8)
+
+    # the int8 matmul needs more than 16 rows and sizes that are multiples of 8
+    n, m = len(q1), len(q2)
+    q1 = F.pad(q1, (0, 0, 0, max(24, n + (-n) % 8) - n))
+    q2 = F.pad(q2, (0, 0, 0, (-m) % 8))
+    dots = torch._int_mm(q1, q2.t())[:n, :m]
+
+    sq1 = (q1[:n].int() ** 2).sum(1, keepdim=True)
+    sq2 = (q2[:m].int() ** 2).sum(1)
+    return (sq1 + sq2 - 2 * dots).float()
+
+
+def ratio_test(des1, des2, ratio=0.8, quantize=False):
+    """Match descriptors with Lowe's ratio test, on single (NxD) or batched (BxNxD) descriptors
+    Returns the mask of the good matches of des1 and the index of their nearest neighbour in des2
+    With quantize the distances of CUDA descriptors are computed in int8
+    """
+    quantize = quantize and des1.is_cuda and hasattr(torch, "_int_mm")
+    if quantize and des1.dim() == 3:
+        good, idxs = zip(*[ratio_test(d1, d2, ratio, quantize) for d1, d2 in zip(des1, des2)])
+        return torch.stack(good), torch.stack(idxs)
+
+    if quantize:
+        # compared as squared distances
+        dists, idxs = int8_sq_dists(des1, des2).topk(2, dim=-1, largest=False)
+        return dists[..., 0] < ratio ** 2 * dists[..., 1], idxs[..., 0]
+
+    dists, idxs = torch.cdist(des1, des2).topk(2, dim=-1, largest=False)
+    return dists[..., 0] < ratio * dists[..., 1], idxs[..., 0]
\ No newline at end of file
@@ -1,4 +1,4 @@
-from .resnet_encoder import ResnetEncoder
+from .resnet_encoder import ResnetEncoder, load_resnet_weights
 from .depth_decoder import DepthDecoder
 from .pose_decoder import PoseDecoder
 from .pose_cnn import PoseCNN
@@ -6,6 +6,8 @@ import torch
 import torch.nn as nn
 import torchvision.models as models
 import torch.utils.model_zoo as model_zoo
+from torch.utils.checkpoint import checkpoint
+from typing import List
 
 
 class ResNetMultiImageInput(models.ResNet):
@@ -33,12 +35,23 @@ class ResNetMultiImageInput(models.ResNet):
                 nn.init.constant_(m.bias, 0)
 
 
-def resnet_multiimage_input(num_layers, pretrained=False, num_input_images=1):
+def load_resnet_weights(num_layers):
+    """Load the ImageNet state dict of a resnet, so that it can be shared by several encoders
+    """
+    weights = getattr(models, "ResNet{}_Weights".format(num_layers), None)
+    if weights is not None:
+        # IMAGENET1K_V1 are the weights of the old model_urls, removed in torchvision 0.13
+        return weights.IMAGENET1K_V1.get_state_dict(progress=True)
+    return model_zoo.load_url(models.resnet.model_urls['resnet{}'.format(num_layers)])
+
+
+def resnet_multiimage_input(num_layers, pretrained=False, num_input_images=1, pretrained_dict=None):
     """Constructs a ResNet model.
     Args:
         num_layers (int): Number of resnet layers. Must be 18 or 50
         pretrained (bool): If True, returns a model pre-trained on ImageNet
         num_input_images (int): Number of frames stacked as input
+        pretrained_dict (dict): Already loaded ImageNet weights, loaded here if None
     """
     assert num_layers in [18, 50], "Can only run with 18 or 50 layer resnet"
     blocks = {18: [2, 2, 2, 2], 50: [3, 4, 6, 3]}[num_layers]
@@ -46,7 +59,10 @@ def resnet_multiimage_input(num_layers, pretrained=False, num_input_images=1):
     model = ResNetMultiImageInput(block_type, blocks, num_input_images=num_input_images)
 
     if pretrained:
-        loaded = model_zoo.load_url(models.resnet.model_urls['resnet{}'.format(num_layers)])
+        if pretrained_dict is None:
+            pretrained_dict = load_resnet_weights(num_layers)
+        # shallow copy, the shared dict must keep its original conv1 weights
+        loaded = dict(pretrained_dict)
         loaded['conv1.weight'] = torch.cat(
             [loaded['conv1.weight']] * num_input_images, 1) / num_input_images
         model.load_state_dict(loaded)
@@ -56,10 +72,12 @@ def resnet_multiimage_input(num_layers, pretrained=False, num_input_images=1):
 class ResnetEncoder(nn.Module):
     """Pytorch module for a resnet encoder
     """
-    def __init__(self, num_layers, pretrained, num_input_images=1):
+    def __init__(self, num_layers, pretrained, num_input_images=1, pretrained_dict=None,
+                 grad_checkpoint=False):
         super(ResnetEncoder, self).__init__()
 
         self.num_ch_enc = np.array([64, 64, 128, 256, 512])
+        self.grad_checkpoint = grad_checkpoint
 
         resnets = {18: models.resnet18,
                    34: models.resnet34,
@@ -71,13 +89,27 @@ class ResnetEncoder(nn.Module):
             raise ValueError("{} is not a valid number of resnet layers".format(num_layers))
 
         if num_input_images > 1:
-            self.encoder = resnet_multiimage_input(num_layers, pretrained, num_input_images)
+            self.encoder = resnet_multiimage_input(num_layers, pretrained, num_input_images, pretrained_dict)
+        elif pretrained and pretrained_dict is not None:
+            self.encoder = resnets[num_layers](False)
+            self.encoder.load_state_dict(pretrained_dict)
         else:
             self.encoder = resnets[num_layers](pretrained)
 
         if num_layers > 34:
             self.num_ch_enc[1:] *= 4
 
+    @torch.jit.unused
+    def checkpointed_layers(self, x: torch.Tensor) -> List[torch.Tensor]:
+        """Run layer1-4 keeping only their outputs, the activations inside the layers are
+        recomputed in the backward pass
+        """
+        features = []
+        for layer in [self.encoder.layer1, self.encoder.layer2, self.encoder.layer3, self.encoder.layer4]:
+            x = checkpoint(layer, x, use_reentrant=False)
+            features.append(x)
+        return features
+
     def forward(self, input_image):
 
         self.features = []
@@ -86,9 +118,12 @@ class ResnetEncoder(nn.Module):
         x = self.encoder.conv1(x)
         x = self.encoder.bn1(x)
         self.features.append(self.encoder.relu(x))
-        self.features.append(self.encoder.layer1(self.encoder.maxpool(self.features[-1])))
-        self.features.append(self.encoder.layer2(self.features[-1]))
-        self.features.append(self.encoder.layer3(self.features[-1]))
-        self.features.append(self.encoder.layer4(self.features[-1]))
+        if self.grad_checkpoint and self.training:
+            self.features.extend(self.checkpointed_layers(self.encoder.maxpool(self.features[-1])))
+        else:
+            self.features.append(self.encoder.layer1(self.encoder.maxpool(self.features[-1])))
+            self.features.append(self.encoder.layer2(self.features[-1]))
+            self.features.append(self.encoder.layer3(self.features[-1]))
+            self.features.append(self.encoder.layer4(self.features[-1]))
 
         return self.features
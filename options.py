@@ -150,6 +150,10 @@ class MonodepthOptions:
                                  help="normal or shared",
                                  default="separate_resnet",
                                  choices=["posecnn", "separate_resnet", "shared"])
+        self.parser.add_argument("--share_pose_encoder",
+                                 help="if set, the pose decoder reuses the position encoder features "
+                                      "instead of running a separate pose encoder, also when evaluating",
+                                 action="store_true")
 
         # SYSTEM options
         self.parser.add_argument("--no_cuda",
@@ -159,6 +163,28 @@ class MonodepthOptions:
                                  type=int,
                                  help="number of dataloader workers",
                                  default=8)
+        self.parser.add_argument("--ddp",
+                                 help="if set, trains with DistributedDataParallel on all the GPUs "
+                                      "started by torchrun",
+                                 action="store_true")
+        self.parser.add_argument("--channels_last",
+                                 help="if set, runs the models in channels_last memory format",
+                                 action="store_true")
+        self.parser.add_argument("--amp",
+                                 help="if set, trains with automatic mixed precision",
+                                 action="store_true")
+        self.parser.add_argument("--amp_dtype",
+                                 type=str,
+                                 help="autocast dtype, bfloat16 needs Ampere or newer and skips loss scaling",
+                                 default="float16",
+                                 choices=["float16", "bfloat16"])
+        self.parser.add_argument("--compile",
+                                 help="if set, compiles the models with torch.compile",
+                                 action="store_true")
+        self.parser.add_argument("--grad_checkpoint",
+                                 help="if set, recomputes the trained resnet encoder activations "
+                                      "in the backward pass to save memory",
+                                 action="store_true")
 
         # LOADING options
         self.parser.add_argument("--load_weights_folder",
@@ -0,0 +1,54 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+cv2 = pytest.importorskip("cv2")
+
+from layers import ratio_test
+
+
+def sift_like_descriptors(n, seed):
+    # integer valued like SIFT, below 128 so the int8 quantization is exact
+    return np.random.RandomState(seed).randint(0, 128, (n, 128)).astype(np.float32)
+
+
+def opencv_ratio_test(des1, des2, ratio=0.8):
+    matches = cv2.BFMatcher(cv2.NORM_L2).knnMatch(des1, des2, k=2)
+    good = np.array([m.distance < ratio * n.distance for m, n in matches])
+    idxs = np.array([m.trainIdx for m, _ in matches])
+    return good, idxs
+
+
+def test_ratio_test_matches_opencv():
+    des1 = sift_like_descriptors(200, 0)
+    des2 = sift_like_descriptors(300, 1)
+    good_cv, idxs_cv = opencv_ratio_test(des1, des2)
+
+    good, idxs = ratio_test(torch.from_numpy(des1), torch.from_numpy(des2))
+
+    np.testing.assert_array_equal(good.numpy(), good_cv)
+    np.testing.assert_array_equal(idxs.numpy()[good_cv], idxs_cv[good_cv])
+
+
+def test_ratio_test_batched():
+    des1 = torch.from_numpy(np.stack([sift_like_descriptors(100, 2), sift_like_descriptors(100, 3)]))
+    des2 = torch.from_numpy(np.stack([sift_like_descriptors(150, 4), sift_like_descriptors(150, 5)]))
+
+    good, idxs = ratio_test(des1, des2)
+
+    for b in range(2):
+        good_b, idxs_b = ratio_test(des1[b], des2[b])
+        assert torch.equal(good[b], good_b)
+        assert torch.equal(idxs[b], idxs_b)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="the int8 distances need CUDA")
+def test_ratio_test_int8_matches_opencv():
+    des1 = sift_like_descriptors(200, 0)
+    des2 = sift_like_descriptors(300, 1)
+    good_cv, idxs_cv = opencv_ratio_test(des1, des2)
+
+    good, idxs = ratio_test(torch.from_numpy(des1).cuda(), torch.from_numpy(des2).cuda(), quantize=True)
+
+    np.testing.assert_array_equal(good.cpu().numpy(), good_cv)
+    np.testing.assert_array_equal(idxs.cpu().numpy()[good_cv], idxs_cv[good_cv])
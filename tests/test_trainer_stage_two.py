@@ -0,0 +1,70 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("cv2")
+pytest.importorskip("tensorboardX")
+
+import trainer_stage_two_new
+from options import MonodepthOptions
+from torch.utils.data import Dataset
+
+
+class DummyDataset(Dataset):
+    """Random frames with the keys and intrinsics of the SCARED dataset
+    """
+    def __init__(self, data_path, filenames, height, width, frame_idxs, num_scales,
+                 is_train=False, img_ext='.jpg'):
+        self.filenames = filenames
+        self.height = height
+        self.width = width
+        self.frame_idxs = frame_idxs
+        self.num_scales = num_scales
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, index):
+        inputs = {}
+        for scale in range(self.num_scales):
+            h = self.height // (2 ** scale)
+            w = self.width // (2 ** scale)
+            for i in self.frame_idxs:
+                inputs[("color", i, scale)] = torch.rand(3, h, w)
+                inputs[("color_aug", i, scale)] = torch.rand(3, h, w)
+
+            K = torch.tensor([[0.82 * w, 0, 0.5 * w, 0],
+                              [0, 1.02 * h, 0.5 * h, 0],
+                              [0, 0, 1, 0],
+                              [0, 0, 0, 1]])
+            inputs[("K", scale)] = K
+            inputs[("inv_K", scale)] = torch.linalg.pinv(K)
+        return inputs
+
+
+@pytest.fixture
+def trainer(tmp_path, monkeypatch):
+    monkeypatch.setattr(trainer_stage_two_new, "readlines", lambda path: ["dummy {} l".format(i) for i in range(4)])
+    monkeypatch.setattr(trainer_stage_two_new.datasets, "SCAREDRAWDataset", DummyDataset)
+    opts = MonodepthOptions().parser.parse_args([
+        "--log_dir", str(tmp_path), "--no_cuda", "--weights_init", "scratch",
+        "--batch_size", "2", "--num_workers", "0", "--height", "64", "--width", "64"])
+    return trainer_stage_two_new.Trainer(opts)
+
+
+def test_process_batch(trainer):
+    trainer.set_train()
+    outputs, losses = trainer.process_batch(next(iter(trainer.train_loader)))
+
+    assert torch.isfinite(losses["loss"])
+    for f_i in trainer.source_frame_ids:
+        assert outputs[("cam_T_cam", 0, f_i)].shape == (2, 4, 4)
+        assert outputs[("refined", 0, f_i)].shape == (2, 3, 64, 64)
+
+
+def test_process_batch_val(trainer):
+    trainer.set_eval()
+    with torch.inference_mode():
+        outputs, losses = trainer.process_batch_val(next(iter(trainer.val_loader)))
+
+    for f_i in trainer.source_frame_ids:
+        assert outputs[("registration", 0, f_i)].shape == (2, 3, 64, 64)
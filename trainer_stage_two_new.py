@@ -1,7 +1,9 @@
 from __future__ import absolute_import, division, print_function
 
+import cv2
 import time
 import json
+import threading
 import datasets
 import networks
 import numpy as np
@@ -11,7 +13,10 @@ import torch.nn as nn
 from utils import *
 from layers import *
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel as DDP
 from tensorboardX import SummaryWriter
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Trainer:
@@ -23,61 +28,80 @@ class Trainer:
         assert self.opt.height % 32 == 0, "'height' must be a multiple of 32"
         assert self.opt.width % 32 == 0, "'width' must be a multiple of 32"
 
-        self.models = {}  # 字典
-        self.parameters_to_train = []  # 列表
-
-        self.device = torch.device("cpu" if self.opt.no_cuda else "cuda")
+        self.models = nn.ModuleDict()
+        # the position network is pretrained in stage one and stays frozen here
+        self.frozen_models = ["position_encoder", "position"]
+
+        if self.opt.ddp:
+            # one process per GPU, the rank and world size come from torchrun
+            torch.distributed.init_process_group("nccl")
+            self.local_rank = int(os.environ["LOCAL_RANK"])
+            torch.cuda.set_device(self.local_rank)
+            self.device = torch.device("cuda", self.local_rank)
+            self.world_size = torch.distributed.get_world_size()
+            self.is_main_process = torch.distributed.get_rank() == 0
+        else:
+            self.device = torch.device("cpu" if self.opt.no_cuda else "cuda")
+            self.world_size = 1
+            self.is_main_process = True
 
         self.num_scales = len(self.opt.scales)  # 4
         self.num_input_frames = len(self.opt.frame_ids)  # 3
         self.num_pose_frames = 2 if self.opt.pose_model_input == "pairs" else self.num_input_frames  # 2
 
         assert self.opt.frame_ids[0] == 0, "frame_ids must start with 0"
+        assert not self.opt.share_pose_encoder or self.opt.pose_model_type == "separate_resnet", \
+            "--share_pose_encoder needs pose_model_type separate_resnet"
 
         self.use_pose_net = not (self.opt.use_stereo and self.opt.frame_ids == [0])
 
         if self.opt.use_stereo:
             self.opt.frame_ids.append("s")
 
+        # the source frames are iterated in every loss and logging loop, so the slice is made once
+        self.source_frame_ids = self.opt.frame_ids[1:]
+
+        # the ImageNet weights are loaded once and shared by all the resnet encoders
+        pretrained_dict = networks.load_resnet_weights(self.opt.num_layers) \
+            if self.opt.weights_init == "pretrained" else None
+
         self.models["encoder"] = networks.ResnetEncoder(
-            self.opt.num_layers, self.opt.weights_init == "pretrained")  # 18
-        self.models["encoder"].to(self.device)
-        self.parameters_to_train += list(self.models["encoder"].parameters())
+            self.opt.num_layers, self.opt.weights_init == "pretrained",
+            pretrained_dict=pretrained_dict, grad_checkpoint=self.opt.grad_checkpoint)  # 18
 
         self.models["depth"] = networks.DepthDecoder(
             self.models["encoder"].num_ch_enc, self.opt.scales)
-        
-        self.models["depth"].to(self.device)
-        self.parameters_to_train += list(self.models["depth"].parameters())
 
         self.models["position_encoder"] = networks.ResnetEncoder(
-            self.opt.num_layers, self.opt.weights_init == "pretrained", num_input_images=2)  # 18
-        self.models["position_encoder"].to(self.device)
+            self.opt.num_layers, self.opt.weights_init == "pretrained", num_input_images=2,
+            pretrained_dict=pretrained_dict)  # 18
 
         self.models["position"] = networks.PositionDecoder(
             self.models["position_encoder"].num_ch_enc, self.opt.scales)
 
-        self.models["position"].to(self.device)
-
         self.models["transform_encoder"] = networks.ResnetEncoder(
-            self.opt.num_layers, self.opt.weights_init == "pretrained", num_input_images=2)  # 18
-        self.models["transform_encoder"].to(self.device)
-        self.parameters_to_train += list(self.models["transform_encoder"].parameters())
+            self.opt.num_layers, self.opt.weights_init == "pretrained", num_input_images=2,
+            pretrained_dict=pretrained_dict, grad_checkpoint=self.opt.grad_checkpoint)  # 18
 
         self.models["transform"] = networks.TransformDecoder(
             self.models["transform_encoder"].num_ch_enc, self.opt.scales)
-        self.models["transform"].to(self.device)
-        self.parameters_to_train += list(self.models["transform"].parameters())
 
         if self.use_pose_net:
 
-            if self.opt.pose_model_type == "separate_resnet":
+            if self.opt.pose_model_type == "separate_resnet" and self.opt.share_pose_encoder:
+                # the pose decoder reuses the features of the position encoder
+                self.models["pose"] = networks.PoseDecoder(
+                    self.models["position_encoder"].num_ch_enc,
+                    num_input_features=1,
+                    num_frames_to_predict_for=2)
+
+            elif self.opt.pose_model_type == "separate_resnet":
                 self.models["pose_encoder"] = networks.ResnetEncoder(
                     self.opt.num_layers,
                     self.opt.weights_init == "pretrained",
-                    num_input_images=self.num_pose_frames)
-                self.models["pose_encoder"].to(self.device)
-                self.parameters_to_train += list(self.models["pose_encoder"].parameters())
+                    num_input_images=self.num_pose_frames,
+                    pretrained_dict=pretrained_dict,
+                    grad_checkpoint=self.opt.grad_checkpoint)
 
                 self.models["pose"] = networks.PoseDecoder(
                     self.models["pose_encoder"].num_ch_enc,
@@ -92,9 +116,6 @@ class Trainer:
                 self.models["pose"] = networks.PoseCNN(
                     self.num_input_frames if self.opt.pose_model_input == "all" else 2)
 
-            self.models["pose"].to(self.device)
-            self.parameters_to_train += list(self.models["pose"].parameters())
-
         if self.opt.predictive_mask:
             assert self.opt.disable_automasking, \
                 "When using predictive_mask, please disable automasking with --disable_automasking"
@@ -104,16 +125,49 @@ class Trainer:
             self.models["predictive_mask"] = networks.DepthDecoder(
                 self.models["encoder"].num_ch_enc, self.opt.scales,
                 num_output_channels=(len(self.opt.frame_ids) - 1))
-            self.models["predictive_mask"].to(self.device)
-            self.parameters_to_train += list(self.models["predictive_mask"].parameters())
 
-        self.model_optimizer = optim.Adam(self.parameters_to_train, self.opt.learning_rate)
+        self.models.to(self.device)
+        for k in self.frozen_models:
+            self.models[k].requires_grad_(False)
+        self.parameters_to_train = [
+            p for k, m in self.models.items() if k not in self.frozen_models for p in m.parameters()]
+
+        # fused Adam updates all parameters in a single kernel, it needs CUDA
+        self.model_optimizer = optim.Adam(self.parameters_to_train, self.opt.learning_rate,
+                                          fused=self.device.type == "cuda")
         self.model_lr_scheduler = optim.lr_scheduler.StepLR(
             self.model_optimizer, self.opt.scheduler_step_size, 0.1)
 
+        # loss scaling is only needed for float16, bfloat16 has the range of float32
+        self.amp_dtype = getattr(torch, self.opt.amp_dtype)
+        self.scaler = torch.cuda.amp.GradScaler(
+            enabled=self.opt.amp and self.amp_dtype == torch.float16)
+
         if self.opt.load_weights_folder is not None:
             self.load_model()
 
+        for k in self.models:
+            if self.opt.channels_last:
+                self.models[k] = self.models[k].to(memory_format=torch.channels_last)
+            if self.opt.ddp and any(p.requires_grad for p in self.models[k].parameters()):
+                # static_graph since the same parameters are used in every step
+                self.models[k] = DDP(self.models[k], device_ids=[self.local_rank],
+                                     bucket_cap_mb=50, static_graph=True)
+            elif self.opt.ddp:
+                # frozen models are not synchronized by DDP, so all ranks take the weights of rank 0
+                for t in self.models[k].state_dict().values():
+                    torch.distributed.broadcast(t, 0)
+            if self.opt.compile:
+                # static shapes (drop_last=True), so the graphs are replayed as CUDA graphs
+                self.models[k] = torch.compile(
+                    self.models[k], mode="reduce-overhead", fullgraph=False, dynamic=False)
+
+        # validation runs on rank 0 only, so it bypasses the DDP wrappers and their collectives
+        self.val_models = {}
+        for k, m in self.models.items():
+            m = getattr(m, "_orig_mod", m)
+            self.val_models[k] = getattr(m, "module", m)
+
         print("Training model named:\n  ", self.opt.model_name)
         print("Models and tensorboard events files are saved to:\n  ", self.opt.log_dir)
         print("Training is using:\n  ", self.device)
@@ -128,25 +182,36 @@ class Trainer:
         img_ext = '.jpg'  
 
         num_train_samples = len(train_filenames)
-        self.num_total_steps = num_train_samples // self.opt.batch_size * self.opt.num_epochs
+        self.num_total_steps = \
+            num_train_samples // (self.opt.batch_size * self.world_size) * self.opt.num_epochs
 
         train_dataset = self.dataset(
             self.opt.data_path, train_filenames, self.opt.height, self.opt.width,
             self.opt.frame_ids, 4, is_train=True, img_ext=img_ext)
+        self.train_sampler = DistributedSampler(train_dataset, shuffle=True) if self.opt.ddp else None
+        # keep the workers alive across epochs and a deeper queue to absorb jpeg decode jitter
+        loader_kwargs = {"persistent_workers": True, "prefetch_factor": 4} if self.opt.num_workers > 0 else {}
         self.train_loader = DataLoader(
-            train_dataset, self.opt.batch_size, True,
-            num_workers=self.opt.num_workers, pin_memory=True, drop_last=True)
+            train_dataset, self.opt.batch_size, self.train_sampler is None, sampler=self.train_sampler,
+            num_workers=self.opt.num_workers, pin_memory=True, drop_last=True,
+            worker_init_fn=seed_worker, **loader_kwargs)
         val_dataset = self.dataset(
             self.opt.data_path, val_filenames, self.opt.height, self.opt.width,
             self.opt.frame_ids, 4, is_train=False, img_ext=img_ext)
         self.val_loader = DataLoader(
             val_dataset, self.opt.batch_size, False,
-            num_workers=1, pin_memory=True, drop_last=True)
+            num_workers=1, pin_memory=True, drop_last=True, persistent_workers=True)
         self.val_iter = iter(self.val_loader)
 
         self.writers = {}
-        for mode in ["train", "val"]:
-            self.writers[mode] = SummaryWriter(os.path.join(self.log_path, mode))
+        if self.is_main_process:
+            for mode in ["train", "val"]:
+                self.writers[mode] = SummaryWriter(os.path.join(self.log_path, mode))
+
+        # images are logged less often and copied to the CPU on a side stream
+        self.image_log_frequency = 10 * self.opt.log_frequency
+        self.log_stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.pending_images = []
 
         if not self.opt.no_ssim:
             self.ssim = SSIM()
@@ -179,6 +244,15 @@ class Trainer:
             self.position_depth[scale] = optical_flow((h, w), self.opt.batch_size, h, w)
             self.position_depth[scale].to(self.device)
 
+        # dynamic shapes since the number of keypoints changes with every pair
+        self.flow2coord_at = torch.compile(flow2coord_at, dynamic=True) if self.opt.compile else flow2coord_at
+        # pairs with fewer matches fall back on the flow at fixed pixels, per flow size
+        self.min_matches = 20
+        self.fallback_pts = {}
+
+        # the OpenCV detectors are set up by init_opencv_matching on first use
+        self.sift_executor = None
+
         self.depth_metric_names = [
             "de/abs_rel", "de/sq_rel", "de/rms", "de/log_rms", "da/a1", "da/a2", "da/a3"]
 
@@ -186,27 +260,27 @@ class Trainer:
         print("There are {:d} training items and {:d} validation items\n".format(
             len(train_dataset), len(val_dataset)))
 
-        self.save_opts()
+        if self.is_main_process:
+            self.save_opts()
+
+    def to_memory_format(self, x):
+        """Convert an image tensor to the memory format the models run in
+        """
+        if self.opt.channels_last:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
 
     def set_train(self):
         """Convert all models to training mode
         """
-        self.models["encoder"].train()
-        self.models["depth"].train()
-        self.models["transform_encoder"].train()
-        self.models["transform"].train()
-        self.models["pose_encoder"].train()
-        self.models["pose"].train()
+        self.models.train()
+        for k in self.frozen_models:
+            self.models[k].eval()
 
     def set_eval(self):
         """Convert all models to testing/evaluation mode
         """
-        self.models["encoder"].eval()
-        self.models["depth"].eval()
-        self.models["transform_encoder"].eval()
-        self.models["transform"].eval()
-        self.models["pose_encoder"].eval()
-        self.models["pose"].eval()
+        self.models.eval()
 
     def train(self):
         """Run the entire training pipeline
@@ -216,8 +290,9 @@ class Trainer:
         self.start_time = time.time()
         for self.epoch in range(self.opt.num_epochs):
             self.run_epoch()
-            if (self.epoch + 1) % self.opt.save_frequency == 0:
+            if (self.epoch + 1) % self.opt.save_frequency == 0 and self.is_main_process:
                 self.save_model()
+        self.write_pending_images(wait=True)
 
     def run_epoch(self):
         """Run a single epoch of training and validation
@@ -227,25 +302,46 @@ class Trainer:
         print("Training")
         self.set_train()
 
-        for batch_idx, inputs in enumerate(self.train_loader):
+        if self.train_sampler is not None:
+            self.train_sampler.set_epoch(self.epoch)
+
+        # on the GPU the steps are timed with events, which are only waited on when logging
+        use_events = self.device.type == "cuda"
+        if use_events:
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+
+        for batch_idx, inputs in enumerate(CUDAPrefetcher(self.train_loader, self.device)):
             
-            before_op_time = time.time()
+            if use_events:
+                start_event.record()
+            else:
+                before_op_time = time.time()
 
-            outputs, losses = self.process_batch(inputs)
+            with torch.cuda.amp.autocast(enabled=self.opt.amp, dtype=self.amp_dtype):
+                outputs, losses = self.process_batch(inputs)
 
-            self.model_optimizer.zero_grad()
-            losses["loss"].backward()
-            self.model_optimizer.step()
+            self.model_optimizer.zero_grad(set_to_none=True)
+            self.scaler.scale(losses["loss"]).backward()
+            self.scaler.step(self.model_optimizer)
+            self.scaler.update()
 
-            duration = time.time() - before_op_time
+            if use_events:
+                end_event.record()
+            else:
+                duration = time.time() - before_op_time
 
             phase = batch_idx % self.opt.log_frequency == 0
 
-            if phase:
+            if phase and self.is_main_process:
 
-                self.log_time(batch_idx, duration, losses["loss"].cpu().data)
-                self.log("train", inputs, outputs, losses)
-                self.val()
+                if use_events:
+                    end_event.synchronize()
+                    duration = start_event.elapsed_time(end_event) / 1000.0
+                self.log_time(batch_idx, duration, losses["loss"].detach())
+                log_images = batch_idx % self.image_log_frequency == 0
+                self.log("train", inputs, outputs, losses, log_images)
+                self.val(log_images)
 
             self.step += 1
             
@@ -255,7 +351,7 @@ class Trainer:
         """Pass a minibatch through the network and generate images and losses
         """
         for key, ipt in inputs.items():
-            inputs[key] = ipt.to(self.device)
+            inputs[key] = ipt.to(self.device, non_blocking=True)
         
         #Not used
         if self.opt.pose_model_type == "shared":
@@ -269,14 +365,17 @@ class Trainer:
             for i, k in enumerate(self.opt.frame_ids):
                 features[k] = [f[i] for f in all_features]
 
-            outputs = self.models["depth"](features[0])
+            depth_outputs = self.models["depth"](features[0])
         else:
             # Otherwise, we only feed the image with frame_id 0 through the depth encoder
             
             #DepthNet Prediction
-            features = self.models["encoder"](inputs["color_aug", 0, 0])
-            outputs = self.models["depth"](features)
+            features = self.models["encoder"](self.to_memory_format(inputs["color_aug", 0, 0]))
+            depth_outputs = self.models["depth"](features)
         
+        # the depth decoder returns the dict it keeps as an attribute, so copy it
+        outputs = {("disp", scale): depth_outputs["disp_"+str(scale)] for scale in self.opt.scales}
+
         #Not used
         #if self.opt.predictive_mask:
         #    outputs["predictive_mask"] = self.models["predictive_mask"](features)
@@ -289,8 +388,9 @@ class Trainer:
 
         return outputs, losses
 
-    def predict_poses(self, inputs, features, disps):
+    def predict_poses(self, inputs, features, disps, need_full=True):
         """Predict poses between input frames for monocular sequences.
+        Without need_full only the flows and the registered images are computed.
         """
         outputs = {}
         if self.num_pose_frames == 2:
@@ -298,79 +398,76 @@ class Trainer:
                 pose_feats = {f_i: features[f_i] for f_i in self.opt.frame_ids}
             else:
                 pose_feats = {f_i: inputs["color_aug", f_i, 0] for f_i in self.opt.frame_ids}
-            #print(pose_feats[0].shape)
-            #print(pose_feats[-1].shape)
-            #print(pose_feats[1].shape)
-            for f_i in self.opt.frame_ids[1:]:
-                if f_i != "s":
-                    
-                    inputs_all = [pose_feats[f_i], pose_feats[0]]
-                    inputs_all_reverse = [pose_feats[0], pose_feats[f_i]]
-
-                    #print("inputs_all",inputs_all[0].shape)
-                    #print("inputs_all_reverse",inputs_all[1].shape)
-                    
-                    # OF Prediction
-                    position_inputs = self.models["position_encoder"](torch.cat(inputs_all, 1))
-                    position_inputs_reverse = self.models["position_encoder"](torch.cat(inputs_all_reverse, 1))
-                    outputs_0 = self.models["position"](position_inputs)
-                    outputs_1 = self.models["position"](position_inputs_reverse)
-                    flow_2D = position_inputs
-                     # recover image shape, to avoid meaningless flow matches
-                    if h_side is not None or w_side is not None:
-                        flow_2D = flow_2D[:,:,:h_side,:w_side]
-                    try:  
-                        conf = conf[:,:,:h_side,:w_side]   
-                    except:
-                        conf = conf
-
-                    # some inputs are left for possible visualization or debug, plz ignore them if not
-                    # return:   Pose matrix             Bx3x4
-                    #           Essential matrix        Bx3x3
-                    P_mat,E_mat = self.pose_by_ransac(flow_2D,ref,target,intrinsic_inv_gpu,
-                                                        h_side,w_side,pose_gt =pose_gt,img_path=img_path)
-                    #print(outputs_0['position', 0][0][0])
-                    #print(outputs_0['position', 0][0][1])
-                    #print(outputs_1['position', 0][0][1].shape)
-                    #print(len(outputs_1))
-                    for scale in self.opt.scales:
-                        outputs["p_"+str(scale)+"_"+str(f_i)] = outputs_0["position_"+str(scale)]
-                        outputs["ph_"+str(scale)+"_"+str(f_i)] = F.interpolate(
-                            outputs["p_"+str(scale)+"_"+str(f_i)], [self.opt.height, self.opt.width], mode="bilinear", align_corners=False)
-                        outputs["r_"+str(scale)+"_"+str(f_i)] = self.spatial_transform(inputs[("color", f_i, 0)], outputs["ph_"+str(scale)+"_"+str(f_i)])
-                        outputs["pr_"+str(scale)+"_"+str(f_i)] = outputs_1["position_"+str(scale)]
-                        outputs["prh_"+str(scale)+"_"+str(f_i)] = F.interpolate(
-                            outputs["pr_"+str(scale)+"_"+str(f_i)], [self.opt.height, self.opt.width], mode="bilinear", align_corners=False)
-                        
-                        outputs["omaskb_"+str(scale)+"_"+str(f_i)],  outputs["omapb_"+str(scale)+"_"+str(f_i)]= self.get_occu_mask_backward(outputs["prh_"+str(scale)+"_"+str(f_i)])
-                        outputs["omapbi_"+str(scale)+"_"+str(f_i)] = self.get_occu_mask_bidirection(outputs["ph_"+str(scale)+"_"+str(f_i)],
-                                                                                                          outputs["prh_"+str(scale)+"_"+str(f_i)])
-
-                    # Input for the AFNet
-                    transform_input = [outputs["r_0"+"_"+str(f_i)], inputs[("color", 0, 0)]]
-                    # Output from AFNet
-                    transform_inputs = self.models["transform_encoder"](torch.cat(transform_input, 1))
-                    outputs_2 = self.models["transform"](transform_inputs)
-
-                    for scale in self.opt.scales:
-
-                        outputs["t_"+str(scale)+"_"+str(f_i)] = outputs_2[("transform", scale)]
-                        outputs["th_"+str(scale)+"_"+str(f_i)] = F.interpolate(
-                            outputs["t_"+str(scale)+"_"+str(f_i)], [self.opt.height, self.opt.width], mode="bilinear", align_corners=False)
-
-                        outputs["ref_"+str(scale)+"_"+str(f_i)] = (outputs["th_"+str(scale)+"_"+str(f_i)] * outputs["omaskb_"+str(scale)+"_"+str(f_i)].detach()  + inputs[("color", 0, 0)])
-                        outputs["ref_"+str(scale)+"_"+str(f_i)] = torch.clamp(outputs["ref_"+str(scale)+"_"+str(f_i)], min=0.0, max=1.0)
-
-                    # Input for PoseNet
-                    pose_inputs = [self.models["pose_encoder"](torch.cat(inputs_all, 1))]
-                    axisangle, translation = self.models["pose"](pose_inputs)
-
-                    outputs["axisangle_0_"+str(f_i)] = axisangle
-                    outputs["translation_0_"+str(f_i)] = translation
-                    outputs["cam_T_cam_0_"+str(f_i)] = transformation_from_parameters(
-                        axisangle[:, 0], translation[:, 0])
-
-                    
+            # OF Prediction
+            # the frozen position network runs once on all the forward and reverse pairs
+            source_frame_ids = [f_i for f_i in self.source_frame_ids if f_i != "s"]
+            num_pairs = 2 * len(source_frame_ids)
+            position_pairs = [torch.cat([pose_feats[f_i], pose_feats[0]], 1) for f_i in source_frame_ids] + \
+                [torch.cat([pose_feats[0], pose_feats[f_i]], 1) for f_i in source_frame_ids]
+            all_position_inputs = self.models["position_encoder"](
+                self.to_memory_format(torch.cat(position_pairs, 0)))
+            position_outputs = self.models["position"](all_position_inputs)
+            all_position_outputs = {scale: position_outputs["position_"+str(scale)] for scale in self.opt.scales}
+            # one upsampling per scale covers the flows of every pair
+            all_position_high = {scale: F.interpolate(v, [self.opt.height, self.opt.width], mode="bilinear",
+                                                      align_corners=False)
+                                 for scale, v in all_position_outputs.items()}
+            all_position_inputs = [torch.chunk(f, num_pairs) for f in all_position_inputs]
+            all_position_outputs = {scale: torch.chunk(v, num_pairs) for scale, v in all_position_outputs.items()}
+            all_position_high = {scale: torch.chunk(v, num_pairs) for scale, v in all_position_high.items()}
+
+            for i, f_i in enumerate(source_frame_ids):
+
+                inputs_all = [pose_feats[f_i], pose_feats[0]]
+
+                position_inputs = [f[i] for f in all_position_inputs]
+                outputs_0 = {scale: v[i] for scale, v in all_position_outputs.items()}
+                outputs_1 = {scale: v[len(source_frame_ids) + i] for scale, v in all_position_outputs.items()}
+                for scale in self.opt.scales:
+                    outputs[("position", scale, f_i)] = outputs_0[scale]
+                    outputs[("position", "high", scale, f_i)] = all_position_high[scale][i]
+                    outputs[("registration", scale, f_i)] = self.spatial_transform(inputs[("color", f_i, 0)], outputs[("position", "high", scale, f_i)])
+                    outputs[("position_reverse", scale, f_i)] = outputs_1[scale]
+                    outputs[("position_reverse", "high", scale, f_i)] = \
+                        all_position_high[scale][len(source_frame_ids) + i]
+                    if not need_full:
+                        continue
+
+                    outputs[("occu_mask_backward", scale, f_i)],  outputs[("occu_map_backward", scale, f_i)]= self.get_occu_mask_backward(outputs[("position_reverse", "high", scale, f_i)])
+                    outputs[("occu_map_bidirection", scale, f_i)] = self.get_occu_mask_bidirection(outputs[("position", "high", scale, f_i)],
+                                                                                                      outputs[("position_reverse", "high", scale, f_i)])
+
+                if not need_full:
+                    continue
+
+                # Input for the AFNet
+                transform_input = [outputs[("registration", 0, f_i)], inputs[("color", 0, 0)]]
+                # Output from AFNet
+                transform_inputs = self.models["transform_encoder"](self.to_memory_format(torch.cat(transform_input, 1)))
+                outputs_2 = self.models["transform"](transform_inputs)
+
+                for scale in self.opt.scales:
+
+                    outputs[("transform", scale, f_i)] = outputs_2[("transform", scale)]
+                    outputs[("transform", "high", scale, f_i)] = F.interpolate(
+                        outputs[("transform", scale, f_i)], [self.opt.height, self.opt.width], mode="bilinear", align_corners=False)
+
+                    outputs[("refined", scale, f_i)] = fuse_ref(
+                        outputs[("transform", "high", scale, f_i)], outputs[("occu_mask_backward", scale, f_i)].detach(),
+                        inputs[("color", 0, 0)])
+
+                # Input for PoseNet
+                if self.opt.share_pose_encoder:
+                    pose_inputs = [position_inputs]
+                else:
+                    pose_inputs = [self.models["pose_encoder"](self.to_memory_format(torch.cat(inputs_all, 1)))]
+                axisangle, translation = self.models["pose"](pose_inputs)
+
+                outputs[("axisangle", 0, f_i)] = axisangle
+                outputs[("translation", 0, f_i)] = translation
+                outputs[("cam_T_cam", 0, f_i)] = transformation_from_parameters(
+                    axisangle[:, 0], translation[:, 0])
+
         return outputs
 
     def generate_images_pred(self, inputs, outputs):
@@ -379,7 +476,7 @@ class Trainer:
         """
         for scale in self.opt.scales:
             
-            disp = outputs["disp_"+str(scale)]
+            disp = outputs[("disp", scale)]
             if self.opt.v1_multiscale:
                 source_scale = scale
             else:
@@ -388,21 +485,21 @@ class Trainer:
 
             _, depth = disp_to_depth(disp, self.opt.min_depth, self.opt.max_depth)
 
-            outputs["depth_"+str(scale)] = depth
+            outputs[("depth", 0, scale)] = depth
 
             source_scale = 0
-            for i, frame_id in enumerate(self.opt.frame_ids[1:]):
+            for i, frame_id in enumerate(self.source_frame_ids):
 
                 if frame_id == "s":
                     T = inputs["stereo_T"]
                 else:
-                    T = outputs["cam_T_cam_0_"+str(frame_id)]
+                    T = outputs[("cam_T_cam", 0, frame_id)]
 
                 # from the authors of https://arxiv.org/abs/1712.00175
                 if self.opt.pose_model_type == "posecnn":
 
-                    axisangle = outputs["axisangle_0_"+str(f_i)]
-                    translation = outputs["translation_0_"+str(f_i)]
+                    axisangle = outputs[("axisangle", 0, frame_id)]
+                    translation = outputs[("translation", 0, frame_id)]
 
                     inv_depth = 1 / depth
                     mean_inv_depth = inv_depth.mean(3, True).mean(2, True)
@@ -410,17 +507,20 @@ class Trainer:
                     T = transformation_from_parameters(
                         axisangle[:, 0], translation[:, 0] * mean_inv_depth[:, 0], frame_id < 0)
 
-                cam_points = self.backproject_depth[source_scale](
-                    depth, inputs[("inv_K", source_scale)])
-                pix_coords = self.project_3d[source_scale](
-                    cam_points, inputs[("K", source_scale)], T)
-
-                outputs["sample_"+str(frame_id)+"_"+str(scale)] = pix_coords
-
-                outputs["color_"+str(frame_id)+"_"+str(scale)] = F.grid_sample(
-                    inputs[("color", frame_id, source_scale)],
-                    outputs["sample_"+str(frame_id)+"_"+str(scale)],
-                    padding_mode="border")
+                # the projection stays in float32
+                with torch.cuda.amp.autocast(enabled=False):
+                    cam_points = self.backproject_depth[source_scale](
+                        depth.float(), inputs[("inv_K", source_scale)])
+                    pix_coords = self.project_3d[source_scale](
+                        cam_points, inputs[("K", source_scale)], T.float())
+
+                # the sampling grid is only used here, so it is not kept in the outputs
+                outputs[("color", frame_id, scale)] = F.grid_sample(
+                    self.to_memory_format(inputs[("color", frame_id, source_scale)]),
+                    pix_coords,
+                    mode="bilinear",
+                    padding_mode="border",
+                    align_corners=False)
 
                 """print("Cam points")
                 print(cam_points.shape)
@@ -441,7 +541,8 @@ class Trainer:
         if self.opt.no_ssim:
             reprojection_loss = l1_loss
         else:
-            ssim_loss = self.ssim(pred, target).mean(1, True)
+            # the variance terms of SSIM cancel catastrophically in half precision
+            ssim_loss = self.ssim(pred.float(), target.float()).mean(1, True)
             reprojection_loss = 0.85 * ssim_loss + 0.15 * l1_loss
 
         return reprojection_loss
@@ -455,7 +556,6 @@ class Trainer:
         for scale in self.opt.scales:
             
             loss = 0
-            loss_reprojection = 0
             loss_transform = 0
             loss_cvt = 0
             
@@ -466,20 +566,28 @@ class Trainer:
 
             #disp = outputs[("disp", scale,0)]
             #disp = outputs[scale]
-            disp = outputs["disp_"+str(scale)]
+            disp = outputs[("disp", scale)]
             color = inputs[("color", 0, scale)]
 
-            for frame_id in self.opt.frame_ids[1:]:
+            # one reprojection loss call for all source frames, each normalised by its own mask
+            num_frames = len(self.source_frame_ids)
+            occu_masks_backward = torch.cat(
+                [outputs[("occu_mask_backward", 0, frame_id)].detach() for frame_id in self.source_frame_ids], 0)
+            reprojection_losses = self.compute_reprojection_loss(
+                torch.cat([outputs[("color", frame_id, scale)] for frame_id in self.source_frame_ids], 0),
+                torch.cat([outputs[("registration", scale, frame_id)] for frame_id in self.source_frame_ids], 0))
+            loss_reprojection = ((reprojection_losses * occu_masks_backward).view(num_frames, -1).sum(1) /
+                                 occu_masks_backward.view(num_frames, -1).sum(1)).sum()
+
+            for frame_id in self.source_frame_ids:
                 
-                occu_mask_backward = outputs["omaskb_"+str(0)+"_"+str(frame_id)].detach()
+                occu_mask_backward = outputs[("occu_mask_backward", 0, frame_id)].detach()
                 
-                loss_reprojection += (
-                    self.compute_reprojection_loss(outputs["color_"+str(frame_id)+"_"+str(scale)], outputs["r_"+str(scale)+"_"+str(frame_id)]) * occu_mask_backward).sum() / occu_mask_backward.sum()
                 loss_transform += (
-                    torch.abs(outputs["r_"+str(scale)+"_"+str(frame_id)] - outputs["r_"+str(scale)+"_"+str(frame_id)].detach()).mean(1, True) * occu_mask_backward).sum() / occu_mask_backward.sum()
+                    torch.abs(outputs[("refined", scale, frame_id)] - outputs[("registration", 0, frame_id)].detach()).mean(1, True) * occu_mask_backward).sum() / occu_mask_backward.sum()
                     # self.compute_reprojection_loss(outputs[("refined", scale, frame_id)], outputs[("registration", 0, frame_id)].detach()) * occu_mask_backward).sum() / occu_mask_backward.sum()
                 loss_cvt += get_smooth_bright(
-                    outputs["th_"+str(scale)+"_"+str(frame_id)], inputs[("color", 0, 0)], outputs["r_"+str(scale)+"_"+str(frame_id)].detach(), occu_mask_backward)
+                    outputs[("transform", "high", scale, frame_id)], inputs[("color", 0, 0)], outputs[("registration", scale, frame_id)].detach(), occu_mask_backward)
 
             mean_disp = disp.mean(2, True).mean(3, True)
             norm_disp = disp / (mean_disp + 1e-7)
@@ -497,19 +605,19 @@ class Trainer:
         losses["loss"] = total_loss
         return losses
     
-    def val(self):
+    def val(self, log_images=True):
         """Validate the model on a single minibatch
         """
         self.set_eval()
         try:
-            inputs = self.val_iter.next()
+            inputs = next(self.val_iter)
         except StopIteration:
             self.val_iter = iter(self.val_loader)
-            inputs = self.val_iter.next()
+            inputs = next(self.val_iter)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs, losses = self.process_batch_val(inputs)
-            self.log("val", inputs, outputs, losses)
+            self.log("val", inputs, outputs, losses, log_images)
             del inputs, outputs, losses
 
         self.set_train()
@@ -518,34 +626,25 @@ class Trainer:
         """Pass a minibatch through the network and generate images and losses
         """
         for key, ipt in inputs.items():
-            inputs[key] = ipt.to(self.device)
+            inputs[key] = ipt.to(self.device, non_blocking=True)
 
+        # only the registration path is needed for the validation loss
+        features = None
         if self.opt.pose_model_type == "shared":
             # If we are using a shared encoder for both depth and pose (as advocated
             # in monodepthv1), then all images are fed separately through the depth encoder.
             all_color_aug = torch.cat([inputs[("color_aug", i, 0)] for i in self.opt.frame_ids])
-            all_features = self.models["encoder"](all_color_aug)
+            all_features = self.val_models["encoder"](all_color_aug)
             all_features = [torch.split(f, self.opt.batch_size) for f in all_features]
 
             features = {}
             for i, k in enumerate(self.opt.frame_ids):
                 features[k] = [f[i] for f in all_features]
 
-            outputs = self.models["depth"](features[0])
-        else:
-            # Otherwise, we only feed the image with frame_id 0 through the depth encoder
-            features = self.models["encoder"](inputs["color_aug", 0, 0])
-            #print(type(features))
-            #print(len(features))
-            outputs = self.models["depth"](features)
-
-        if self.opt.predictive_mask:
-            outputs["predictive_mask"] = self.models["predictive_mask"](features)
-
+        outputs = {}
         if self.use_pose_net:
-            outputs.update(self.predict_poses(inputs, features, outputs))
+            outputs.update(self.predict_poses(inputs, features, outputs, need_full=False))
 
-        self.generate_images_pred(inputs, outputs)
         losses = self.compute_losses_val(inputs, outputs)
 
         return outputs, losses
@@ -563,9 +662,9 @@ class Trainer:
 
             target = inputs[("color", 0, 0)]
 
-            for frame_id in self.opt.frame_ids[1:]:
+            for frame_id in self.source_frame_ids:
                 registration_losses.append(
-                    ncc_loss(outputs["r_"+str(scale)+"_"+str(frame_id)].mean(1, True), target.mean(1, True)))
+                    ncc_loss(outputs[("registration", scale, frame_id)].mean(1, True), target.mean(1, True)))
 
             registration_losses = torch.cat(registration_losses, 1)
             registration_losses, idxs_registration = torch.min(registration_losses, dim=1)
@@ -582,6 +681,7 @@ class Trainer:
     def log_time(self, batch_idx, duration, loss):
         """Print a logging statement to the terminal
         """
+        loss = loss.item()
         samples_per_sec = self.opt.batch_size / duration
         time_sofar = time.time() - self.start_time
         training_time_left = (
@@ -591,34 +691,81 @@ class Trainer:
         print(print_string.format(self.epoch, batch_idx, samples_per_sec, loss,
                                   sec_to_hm_str(time_sofar), sec_to_hm_str(training_time_left)))
 
-    def log(self, mode, inputs, outputs, losses):
+    def log(self, mode, inputs, outputs, losses, log_images=True):
         """Write an event to the tensorboard events file
         """
         writer = self.writers[mode]
-        
-        for l, v in losses.items():
+
+        # the scalars are moved to the CPU together, with a single sync
+        values = torch.stack([v.detach().float() for v in losses.values()]).cpu().tolist()
+        for l, v in zip(losses.keys(), values):
             writer.add_scalar("{}".format(l), v, self.step)
 
-        for j in range(min(4, self.opt.batch_size)):  # write a maxmimum of four images
-            for s in self.opt.scales:
-                for frame_id in self.opt.frame_ids[1:]:
-
-                    writer.add_image(
-                        "brightness_{}_{}/{}".format(frame_id, s, j),
-                        outputs["th_"+str(s)+"_"+str(frame_id)][j].data, self.step)
-                    writer.add_image(
-                        "registration_{}_{}/{}".format(frame_id, s, j),
-                        outputs["r_"+str(s)+"_"+str(frame_id)][j].data, self.step)
-                    writer.add_image(
-                        "refined_{}_{}/{}".format(frame_id, s, j),
-                        outputs["ref_"+str(s)+"_"+str(frame_id)][j].data, self.step)
-                    if s == 0:
-                        writer.add_image(
-                            "occu_mask_backward_{}_{}/{}".format(frame_id, s, j),
-                            outputs["omaskb_"+str(s)+"_"+str(frame_id)][j].data, self.step)
-
-                writer.add_image("disp_{}/{}".format(s, j),normalize_image(outputs["disp_"+ str(s)][j]), self.step)
-                    
+        self.write_pending_images()
+        if not log_images:
+            return
+
+        images = {}
+        for s in self.opt.scales:
+            for frame_id in self.source_frame_ids:
+                # validation batches only carry the registered images
+                if ("transform", "high", s, frame_id) in outputs:
+                    images["brightness_{}_{}".format(frame_id, s)] = outputs[("transform", "high", s, frame_id)]
+                images["registration_{}_{}".format(frame_id, s)] = outputs[("registration", s, frame_id)]
+                if ("refined", s, frame_id) in outputs:
+                    images["refined_{}_{}".format(frame_id, s)] = outputs[("refined", s, frame_id)]
+                if s == 0 and ("occu_mask_backward", s, frame_id) in outputs:
+                    images["occu_mask_backward_{}_{}".format(frame_id, s)] = \
+                        outputs[("occu_mask_backward", s, frame_id)]
+
+            if ("disp", s) in outputs:
+                images["disp_{}".format(s)] = outputs[("disp", s)]
+
+        # write a maxmimum of four images
+        images = {k: v[:min(4, self.opt.batch_size)].detach() for k, v in images.items()}
+        self.pending_images.append((mode, self.step) + self.images_to_cpu(images))
+
+    def images_to_cpu(self, images):
+        """Start copying a dict of image batches to pinned CPU memory on the logging stream
+        """
+        if self.log_stream is None:
+            return {k: v.cpu() for k, v in images.items()}, None
+
+        if self.opt.compile:
+            # compiled outputs live in the CUDA graph pool and are overwritten by the next replay
+            images = {k: v.clone() for k, v in images.items()}
+
+        self.log_stream.wait_stream(torch.cuda.current_stream(self.device))
+        cpu_images = {}
+        with torch.cuda.stream(self.log_stream):
+            for k, v in images.items():
+                # keeps the allocator from reusing the memory before the copy has run
+                v.record_stream(self.log_stream)
+                cpu_images[k] = torch.empty(v.shape, dtype=v.dtype, pin_memory=True)
+                cpu_images[k].copy_(v, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.log_stream)
+        return cpu_images, event
+
+    def write_pending_images(self, wait=False):
+        """Write the images whose copy to the CPU has completed, or all of them if wait is set
+        """
+        remaining = []
+        for mode, step, cpu_images, event in self.pending_images:
+            if event is not None and not wait and not event.query():
+                remaining.append((mode, step, cpu_images, event))
+                continue
+            if event is not None:
+                event.synchronize()
+
+            writer = self.writers[mode]
+            for name, imgs in cpu_images.items():
+                for j in range(imgs.shape[0]):
+                    img = imgs[j].float()
+                    if name.startswith("disp"):
+                        img = normalize_image(img)
+                    writer.add_image("{}/{}".format(name, j), img, step)
+        self.pending_images = remaining
 
     def save_opts(self):
         """Save options to disk so we know what we ran this experiment with
@@ -639,6 +786,9 @@ class Trainer:
             os.makedirs(save_folder)
 
         for model_name, model in self.models.items():
+            # save the weights of the original module, not of the torch.compile / DDP wrappers
+            model = getattr(model, "_orig_mod", model)
+            model = getattr(model, "module", model)
             save_path = os.path.join(save_folder, "{}.pth".format(model_name))
             save_path2 = os.path.join(save_folder, "{}.pt".format(model_name))
             to_save = model.state_dict()
@@ -668,19 +818,23 @@ class Trainer:
 
         assert os.path.isdir(self.opt.load_weights_folder), \
             "Cannot find folder {}".format(self.opt.load_weights_folder)
-        print("loading model from folder {}".format(self.opt.load_weights_folder))
+        verbose = self.is_main_process
+        if verbose:
+            print("loading model from folder {}".format(self.opt.load_weights_folder))
 
         for n in self.opt.models_to_load:
-            print("Loading {} weights...".format(n))
+            if verbose:
+                print("Loading {} weights...".format(n))
             path = os.path.join(self.opt.load_weights_folder, "{}.pth".format(n))
-            model_dict = self.models[n].state_dict()
-            pretrained_dict = torch.load(path)
-            pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
-            model_dict.update(pretrained_dict)
-            self.models[n].load_state_dict(model_dict)
+            # keys that are not in the model, like the image size saved with the encoder, are skipped
+            missing_keys, unexpected_keys = self.models[n].load_state_dict(
+                torch.load(path, map_location=self.device, mmap=True, weights_only=True), strict=False)
+            if verbose and missing_keys:
+                print("  missing keys: {}".format(", ".join(missing_keys)))
+            if verbose and unexpected_keys:
+                print("  unexpected keys: {}".format(", ".join(unexpected_keys)))
             self.models[n].eval()
-            for param in self.models[n].parameters():
-                param.requires_grad = False
+            self.models[n].requires_grad_(False)
 
         # loading adam state
         # optimizer_load_path = os.path.join(self.opt.load_weights_folder, "adam.pth")
@@ -689,86 +843,74 @@ class Trainer:
             # optimizer_dict = torch.load(optimizer_load_path)
             # self.model_optimizer.load_state_dict(optimizer_dict)
         # else:
-        print("Adam is randomly initialized")
+        if verbose:
+            print("Adam is randomly initialized")
     
+    @torch.inference_mode()
+    @torch.cuda.amp.autocast(enabled=False)
     def pose_by_ransac(self, flow_2D, ref, target, intrinsic_inv_gpu,h_side, w_side, pose_gt=False, img_path=None):
+        """Estimate the relative poses of a batch with a five-point RANSAC on keypoint and flow matches.
+        Not used in training: it needs the compute_P_matrix_ransac CUDA extension and its settings
+        (cfg, delta, alpha, maxreps, ransac_iter, ransac_threshold), which are not part of this repository
+        """
+        if "compute_P_matrix_ransac" not in globals():
+            raise NotImplementedError("pose_by_ransac needs the compute_P_matrix_ransac CUDA extension")
 
+        # float32 coordinates, see flow2coord_at
+        flow_2D = flow_2D.float(); intrinsic_inv_gpu = intrinsic_inv_gpu.float()
         b, _, h, w = flow_2D.size()
-        coord1_flow_2D, coord2_flow_2D = flow2coord(flow_2D)    # Bx3x(H*W) 
-        coord1_flow_2D = coord1_flow_2D.view(b,3,h,w)        
-        coord2_flow_2D = coord2_flow_2D.view(b,3,h,w)    
         margin = 10                 # avoid corner case
 
 
-        E_mat = torch.zeros(b, 3, 3).cuda()                     # Bx3x3
-        P_mat = torch.zeros(b, 3, 4).cuda()                     # Bx3x4
+        E_mat = torch.zeros(b, 3, 3, device=flow_2D.device)     # Bx3x3
+        P_mat = torch.zeros(b, 3, 4, device=flow_2D.device)     # Bx3x4
 
-        PTS1=[]; PTS2=[];                                       # point list
-
-        # process the frames of each batch
-        for b_cv in range(b):
-            # convert images to cv2 style
-            if h_side is not None or w_side is not None:
-                ref_cv =ref[b_cv,:,:h_side,:w_side].cpu().numpy().transpose(1,2,0)[:,:,::-1]
-                tar_cv =target[b_cv,:,:h_side,:w_side].cpu().numpy().transpose(1,2,0)[:,:,::-1]
-            else:
-                ref_cv =ref[b_cv].cpu().numpy().transpose(1,2,0)[:,:,::-1]
-                tar_cv =target[b_cv].cpu().numpy().transpose(1,2,0)[:,:,::-1]
-            ref_cv = (ref_cv*0.5+0.5)*255; tar_cv = (tar_cv*0.5+0.5)*255
-
-            # detect key points           
-            kp1, des1 = self.sift.detectAndCompute(ref_cv.astype(np.uint8),None)
-            kp2, des2 = self.sift.detectAndCompute(tar_cv.astype(np.uint8),None)
-            if len(kp1)<self.min_matches or len(kp2)<self.min_matches:
-                # surf generally has more kps than sift
-                kp1, des1 = self.surf.detectAndCompute(ref_cv.astype(np.uint8),None)
-                kp2, des2 = self.surf.detectAndCompute(tar_cv.astype(np.uint8),None)
-
-            try:
-                # filter out some key points
-                matches = self.flann.knnMatch(des1,des2,k=2)
-                good = []; pts1 = []; pts2 = []
-                for i,(m,n) in enumerate(matches):
-                    if m.distance < 0.8*n.distance: good.append(m); pts1.append(kp1[m.queryIdx].pt); pts2.append(kp2[m.trainIdx].pt)
-                
-                # degengrade if not existing good matches
-                if len(good)<self.min_matches:
-                    good = [];pts1 = [];pts2 = []
-                    for i,(m,n) in enumerate(matches):
-                        good.append(m); pts1.append(kp1[m.queryIdx].pt); pts2.append(kp2[m.trainIdx].pt)
-                pts1 = np.array(pts1); PTS1.append(pts1);pts2 = np.array(pts2); PTS2.append(pts2);
-            except:
-                # if cannot find corresponding pairs, ignore this sift mask 
-                PTS1.append([None]); PTS2.append([None])
-
-        assert len(PTS1)==b
+        if self.sift_executor is None:
+            self.init_opencv_matching()
+        # cv2 style images (BGR, uint8, HxWxC) are made on the GPU, so only those bytes are copied
+        ref_cv, tar_cv = [((img[:, [2,1,0], :h_side, :w_side]*0.5+0.5)*255).clamp(0,255).to(torch.uint8)
+                          .permute(0,2,3,1).contiguous() for img in (ref, target)]
+        ref_host, tar_host, copy_done = self.copy_pairs_to_host(ref_cv, tar_cv)
+        # each pair is collected right before its RANSAC, so detection overlaps with the GPU work
+        pair_jobs = [self.sift_executor.submit(self.detect_pair, ref_host[b_cv], tar_host[b_cv], copy_done)
+                     for b_cv in range(b)]
+        PTS1 = [None] * b; PTS2 = [None] * b
 
         for batch in range(b):
-            if cfg.SIFT_POSE:
-                # if directly use SIFT matches
+            PTS1[batch], PTS2[batch] = pair_jobs[batch].result()
+
+            if cfg.SIFT_POSE and PTS1[batch] is not None:
+                # if directly use SIFT matches, pairs without any match fall back on the flow below
                 pts1 = PTS1[batch]; pts2 = PTS2[batch]
-                coord1_sift_2D = torch.FloatTensor(pts1)
-                coord2_sift_2D = torch.FloatTensor(pts2)
-                coord1_flow_2D_norm_i = torch.cat((coord1_sift_2D,torch.ones(len(coord1_sift_2D),1)),dim=1).unsqueeze(0).to(coord1_flow_2D.device).permute(0,2,1)
-                coord2_flow_2D_norm_i = torch.cat((coord2_sift_2D,torch.ones(len(coord2_sift_2D),1)),dim=1).unsqueeze(0).to(coord1_flow_2D.device).permute(0,2,1)
+                # uploaded asynchronously through pinned memory
+                coord1_sift_2D = torch.from_numpy(np.float32(pts1)).pin_memory().to(flow_2D.device, non_blocking=True)
+                coord2_sift_2D = torch.from_numpy(np.float32(pts2)).pin_memory().to(flow_2D.device, non_blocking=True)
+                coord1_flow_2D_norm_i = F.pad(coord1_sift_2D, (0, 1), value=1.0).unsqueeze(0).permute(0,2,1)
+                coord2_flow_2D_norm_i = F.pad(coord2_sift_2D, (0, 1), value=1.0).unsqueeze(0).permute(0,2,1)
             else:
                 # check the number of matches
-                if len(PTS1[batch])<self.min_matches or len(PTS2[batch])<self.min_matches:
-                    coord1_flow_2D_norm_i = coord1_flow_2D[batch,:,margin:-margin,margin:-margin].contiguous().view(3,-1).unsqueeze(0)
-                    coord2_flow_2D_norm_i = coord2_flow_2D[batch,:,margin:-margin,margin:-margin].contiguous().view(3,-1).unsqueeze(0)                
+                if PTS1[batch] is None or len(PTS1[batch])<self.min_matches or len(PTS2[batch])<self.min_matches:
+                    # use the flow at a fixed random subset of the pixels inside the margin
+                    if (h, w) not in self.fallback_pts:
+                        idx = torch.randperm((h-2*margin)*(w-2*margin), device=flow_2D.device)[:2048]
+                        self.fallback_pts[(h, w)] = torch.stack((idx % (w-2*margin), idx // (w-2*margin)), 1) + margin
+                    coord1_flow_2D_norm_i, coord2_flow_2D_norm_i = self.flow2coord_at(flow_2D[batch], self.fallback_pts[(h, w)])
+                    coord1_flow_2D_norm_i = coord1_flow_2D_norm_i.unsqueeze(0)
+                    coord2_flow_2D_norm_i = coord2_flow_2D_norm_i.unsqueeze(0)
                 else:
                     if cfg.SAMPLE_SP:
-                        # conduct interpolation
-                        pts1 = torch.from_numpy(PTS1[batch]).to(coord1_flow_2D.device).type_as(coord1_flow_2D)
-                        B, C, H, W = coord1_flow_2D.size()
-                        pts1[:,0] = 2.0*pts1[:,0]/max(W-1,1)-1.0;pts1[:,1] = 2.0*pts1[:,1]/max(H-1,1)-1.0
-                        coord1_flow_2D_norm_i = F.grid_sample(coord1_flow_2D[batch].unsqueeze(0), pts1.unsqueeze(0).unsqueeze(-2),align_corners=True).squeeze(-1)
-                        coord2_flow_2D_norm_i = F.grid_sample(coord2_flow_2D[batch].unsqueeze(0), pts1.unsqueeze(0).unsqueeze(-2),align_corners=True).squeeze(-1)
+                        # conduct interpolation, only the flow is sampled at the keypoints
+                        pts1 = torch.from_numpy(PTS1[batch]).to(flow_2D.device).float()
+                        coord1_sp = pts1.t()
+                        coord2_sp = coord1_sp + bilinear_gather(flow_2D[batch], pts1)
+                        coord1_flow_2D_norm_i = F.pad(coord1_sp, (0, 0, 0, 1), value=1.0).unsqueeze(0)
+                        coord2_flow_2D_norm_i = F.pad(coord2_sp, (0, 0, 0, 1), value=1.0).unsqueeze(0)
                     else:
-                        # default choice
-                        pts1 = np.int32(np.round(PTS1[batch]))
-                        coord1_flow_2D_norm_i = coord1_flow_2D[batch,:,pts1[:,1],pts1[:,0]].unsqueeze(0)
-                        coord2_flow_2D_norm_i = coord2_flow_2D[batch,:,pts1[:,1],pts1[:,0]].unsqueeze(0)
+                        # default choice, the coordinates are only computed at the keypoints
+                        pts1 = torch.from_numpy(np.int64(np.round(PTS1[batch]))).to(flow_2D.device)
+                        coord1_flow_2D_norm_i, coord2_flow_2D_norm_i = self.flow2coord_at(flow_2D[batch], pts1)
+                        coord1_flow_2D_norm_i = coord1_flow_2D_norm_i.unsqueeze(0)
+                        coord2_flow_2D_norm_i = coord2_flow_2D_norm_i.unsqueeze(0)
 
             intrinsic_inv_gpu_i = intrinsic_inv_gpu[batch].unsqueeze(0)
 
@@ -778,14 +920,91 @@ class Trainer:
             # reshape coordinates            
             coord1_flow_2D_norm_i = coord1_flow_2D_norm_i.transpose(1,2)[0,:,:2].contiguous()
             coord2_flow_2D_norm_i = coord2_flow_2D_norm_i.transpose(1,2)[0,:,:2].contiguous()
-            
-            with autocast(enabled=False):
-                # GPU-accelerated RANSAC five-point algorithm
-                E_i, P_i, F_i,inlier_num = compute_P_matrix_ransac(coord1_flow_2D_norm_i.detach(), coord2_flow_2D_norm_i.detach(), 
-                                                                intrinsic_inv_gpu[batch,:,:], self.delta, self.alpha, self.maxreps, 
-                                                                len(coord1_flow_2D_norm_i), len(coord1_flow_2D_norm_i), 
-                                                                self.ransac_iter, self.ransac_threshold) 
 
-            E_mat[batch, :, :] = E_i.detach(); P_mat[batch, :, :] = P_i.detach()
+            # one call per pair, before the next one is collected; the extension is not CUDA graph capturable
+            # GPU-accelerated RANSAC five-point algorithm
+            E_i, P_i, F_i,inlier_num = compute_P_matrix_ransac(coord1_flow_2D_norm_i, coord2_flow_2D_norm_i, 
+                                                            intrinsic_inv_gpu[batch,:,:], self.delta, self.alpha, self.maxreps, 
+                                                            len(coord1_flow_2D_norm_i), len(coord1_flow_2D_norm_i), 
+                                                            self.ransac_iter, self.ransac_threshold) 
 
-        return P_mat, E_mat
\ No newline at end of file
+            E_mat[batch, :, :] = E_i; P_mat[batch, :, :] = P_i
+
+        return P_mat, E_mat
+
+    def init_opencv_matching(self):
+        """Create the OpenCV detectors and matcher of pose_by_ransac and the thread pool they run in
+        """
+        self.sift = cv2.SIFT_create() if hasattr(cv2, "SIFT_create") else cv2.xfeatures2d.SIFT_create()
+        try:
+            self.surf = cv2.xfeatures2d.SURF_create()
+        except (AttributeError, cv2.error):
+            # surf needs an opencv-contrib build with the non-free algorithms
+            self.surf = None
+        # kd-tree matcher with bounded checks, shared by the threads under a lock
+        self.flann = cv2.FlannBasedMatcher(dict(algorithm=1, trees=4), dict(checks=32))
+        self.flann_lock = threading.Lock()
+
+        # the images are copied to pinned memory on a side stream
+        self.ransac_stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.ransac_host = None
+        # one pair per usable core, with single threaded OpenCV
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+        self.sift_executor = ThreadPoolExecutor(max_workers=min(self.opt.batch_size, num_cores))
+        cv2.setNumThreads(0)
+
+    def copy_pairs_to_host(self, ref, target):
+        """Start copying the cv2 style reference and target images to pinned host memory on the
+        RANSAC stream. Returns the host images and the event marking the end of the copy
+        """
+        shape = (2,) + tuple(ref.shape)
+        if self.ransac_host is None or tuple(self.ransac_host.shape) != shape:
+            self.ransac_host = torch.empty(shape, dtype=ref.dtype, pin_memory=self.ransac_stream is not None)
+
+        if self.ransac_stream is None:
+            self.ransac_host[0].copy_(ref); self.ransac_host[1].copy_(target)
+            return self.ransac_host[0], self.ransac_host[1], None
+
+        self.ransac_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.ransac_stream):
+            self.ransac_host[0].copy_(ref, non_blocking=True)
+            self.ransac_host[1].copy_(target, non_blocking=True)
+            copy_done = torch.cuda.Event()
+            copy_done.record(self.ransac_stream)
+        return self.ransac_host[0], self.ransac_host[1], copy_done
+
+    def detect_pair(self, ref, target, copy_done=None):
+        """Detect and match the keypoints of one image pair with OpenCV, runs in the thread pool
+        """
+        if copy_done is not None:
+            copy_done.synchronize()
+        # the images are already in cv2 style
+        ref_cv = ref.numpy(); tar_cv = target.numpy()
+
+        # detect key points           
+        kp1, des1 = self.sift.detectAndCompute(ref_cv,None)
+        kp2, des2 = self.sift.detectAndCompute(tar_cv,None)
+        if (len(kp1)<self.min_matches or len(kp2)<self.min_matches) and self.surf is not None:
+            # surf generally has more kps than sift
+            kp1, des1 = self.surf.detectAndCompute(ref_cv,None)
+            kp2, des2 = self.surf.detectAndCompute(tar_cv,None)
+
+        # too few key points even with surf, the pair falls back on the flow without matching
+        if len(kp1)<self.min_matches or len(kp2)<self.min_matches or \
+                des1 is None or des2 is None or len(des1)<2 or len(des2)<2:
+            # if cannot find corresponding pairs, ignore this sift mask 
+            return None, None
+
+        # filter out some key points
+        with self.flann_lock:
+            matches = self.flann.knnMatch(des1,des2,k=2)
+        # one pass to read the matches, the ratio test and the point lookup work on arrays
+        matches = np.array([(m.distance, n.distance, m.queryIdx, m.trainIdx) for m,n in matches]).reshape(-1, 4)
+        good = matches[:, 0] < 0.8*matches[:, 1]
+
+        # degengrade if not existing good matches
+        if good.sum()<self.min_matches:
+            good[:] = True
+        pts1 = np.array([kp.pt for kp in kp1])[matches[good, 2].astype(np.int64)]
+        pts2 = np.array([kp.pt for kp in kp2])[matches[good, 3].astype(np.int64)]
+        return pts1, pts2
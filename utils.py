@@ -1,7 +1,10 @@
 from __future__ import absolute_import, division, print_function
 import os
+import random
 import hashlib
 import zipfile
+import torch
+import numpy as np
 from six.moves import urllib
 
 
@@ -13,6 +16,14 @@ def readlines(filename):
     return lines
 
 
+def seed_worker(worker_id):
+    """Seed numpy and random in each dataloader worker from the torch seed
+    """
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
 def normalize_image(x):
     """Rescale image pixels to span range [0, 1]
     """
@@ -106,3 +117,48 @@ def download_model_if_doesnt_exist(model_name):
             f.extractall(model_path)
 
         print("   Model unzipped to {}".format(model_path))
+
+
+class CUDAPrefetcher:
+    """Iterate over a DataLoader and copy the next batch to the device on a side stream
+    while the current batch is being processed
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, loader_iter):
+        """Fetch the next batch and issue its host to device copies
+        """
+        try:
+            inputs = next(loader_iter)
+        except StopIteration:
+            return None, None
+
+        if self.stream is None:
+            return {key: ipt.to(self.device) for key, ipt in inputs.items()}, None
+
+        # the source tensors are in pinned memory, so the copies run asynchronously
+        with torch.cuda.stream(self.stream):
+            inputs = {key: ipt.to(self.device, non_blocking=True) for key, ipt in inputs.items()}
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        return inputs, copied
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        inputs, copied = self.preload(loader_iter)
+        while inputs is not None:
+            if copied is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(copied)
+                # the tensors were allocated on the side stream but are freed on this one
+                for ipt in inputs.values():
+                    ipt.record_stream(current_stream)
+            next_inputs, next_copied = self.preload(loader_iter)
+            yield inputs
+            inputs, copied = next_inputs, next_copied